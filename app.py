@@ -1,8 +1,13 @@
 import streamlit as st
 import chess
 import chess.engine
+import chess.polyglot
 import os
 import shutil
+import atexit
+import functools
+import threading
+from collections import Counter
 from streamlit_chessboard import chessboard
 
 # ================= 1. PAGE CONFIG =================
@@ -22,6 +27,7 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # ================= 2. ENGINE SETUP =================
+@functools.lru_cache(maxsize=1)
 def get_stockfish_path():
     if os.path.exists("stockfish.exe"): return "stockfish.exe"
     path = shutil.which("stockfish")
@@ -29,40 +35,177 @@ def get_stockfish_path():
     if os.path.exists("/usr/games/stockfish"): return "/usr/games/stockfish"
     return None
 
-def get_engine():
+def start_engine():
     path = get_stockfish_path()
     if not path:
         return None
     try:
-        return chess.engine.SimpleEngine.popen_uci(path)
-    except: return None
+        engine = chess.engine.SimpleEngine.popen_uci(path)
+    except (OSError, chess.engine.EngineError):
+        return None
+    try:
+        # Stay small on shared hosts
+        engine.configure({"Threads": 1, "Hash": 32})
+    except chess.engine.EngineError:
+        engine.quit()
+        return None
+    atexit.register(engine.quit)
+    return engine
+
+@st.cache_resource
+def engine_slot():
+    # One Stockfish process for the whole server, so we skip the fork + UCI
+    # handshake on every move. Hold the lock around every engine call so one
+    # session's command never cancels another's search. A failed start is
+    # kept as None so it isn't retried on every rerun
+    return {"engine": start_engine(), "lock": threading.RLock()}
+
+def get_engine():
+    return engine_slot()["engine"]
+
+def drop_engine(engine):
+    # Stockfish failed, swap in a fresh one unless another session already did
+    slot = engine_slot()
+    with slot["lock"]:
+        if slot["engine"] is engine:
+            # Not every EngineError kills the process, so shut it down too
+            atexit.unregister(engine.quit)
+            try:
+                engine.close()
+            except (OSError, chess.engine.EngineError):
+                pass
+            slot["engine"] = start_engine()
+    st.session_state.ponder = None
+
+@st.cache_resource
+def get_book():
+    # Optional polyglot opening book next to app.py
+    try:
+        return chess.polyglot.open_reader(os.path.join(os.path.dirname(__file__), "book.bin"))
+    except FileNotFoundError: return None
+
+def book_move(board):
+    book = get_book()
+    if not book or board.ply() >= 10:
+        return None
+    try:
+        return book.weighted_choice(board).move
+    except IndexError: return None
 
 # ================= 3. STATE MANAGEMENT =================
+# Board and its derived keys are only built on the first run of a session
 if 'board' not in st.session_state:
-    st.session_state.board = chess.Board()
-if 'ai_side' not in st.session_state:
-    st.session_state.ai_side = chess.BLACK
-if 'history' not in st.session_state:
-    st.session_state.history = []
+    board = chess.Board()
+    st.session_state.board = board
+    st.session_state.last_fen = board.fen()
+    st.session_state.pos_key = chess.polyglot.zobrist_hash(board)
+    st.session_state.repetitions = Counter([st.session_state.pos_key])
+
+defaults = {"ai_is_white": False, "history": [], "ponder": None, "last_processed_uci": None, "game_id": 0}
+for key, value in defaults.items():
+    st.session_state.setdefault(key, value)
 
 # ================= 4. LOGIC =================
-def make_ai_move():
-    if st.session_state.board.is_game_over(): return
+def remember_position():
+    # Call after every push/reset so reruns compare cached values.
+    # After a pawn move or capture no earlier position can come back, so
+    # drop the move stack and repetition counts there. The stack stays short
+    # but Stockfish still sees every position that could repeat
+    board = st.session_state.board
+    if board.halfmove_clock == 0:
+        board.clear_stack()
+        st.session_state.repetitions = Counter()
+    st.session_state.last_fen = board.fen()
+    st.session_state.pos_key = chess.polyglot.zobrist_hash(board)
+    st.session_state.repetitions[st.session_state.pos_key] += 1
+
+@st.cache_data(max_entries=256)
+def fen_key(fen):
+    # None for a malformed FEN, so the move is treated as not yet applied
+    try:
+        return chess.polyglot.zobrist_hash(chess.Board(fen))
+    except ValueError: return None
+
+def game_over():
+    # Works on the session board only, since the repetition counter is kept
+    # for it. Cheap checks first, threefold comes from the Zobrist counter in
+    # O(1) instead of replaying the move stack
+    board = st.session_state.board
+    return (board.is_checkmate() or board.is_stalemate()
+            or board.is_insufficient_material() or board.halfmove_clock >= 100
+            or st.session_state.repetitions[st.session_state.pos_key] >= 3)
+
+def stop_ponder(user_move=None):
+    # Returns the pondered reply if the user played the expected move.
+    # Another session's search may already have cut the ponder short, the
+    # depth check below throws away anything too shallow
+    if not st.session_state.ponder: return None
+    engine, ponder = st.session_state.ponder
+    st.session_state.ponder = None
+    try:
+        with engine_slot()["lock"]:
+            ponder.stop()
+            info = ponder.info
+    except chess.engine.EngineError:
+        drop_engine(engine)
+        return None
+    pv = info.get("pv")
+    # Only trust the line once it got as deep as a normal search would.
+    # Depth counts from before the user's move, so pv[1] is one ply less
+    if (user_move and pv and len(pv) > 1 and pv[0] == user_move
+            and info.get("depth", 0) >= st.session_state.ai_depth + 1):
+        return pv[1]
+    return None
+
+def make_ai_move(reply=None):
+    if game_over(): return
     
-    engine = get_engine()
-    if engine:
-        # Think for 0.5 seconds for speed
-        result = engine.play(st.session_state.board, chess.engine.Limit(time=0.5))
-        st.session_state.board.push(result.move)
-        st.session_state.history.append(f"AI: {result.move}")
-        engine.quit()
+    stop_ponder()
+    # Openings come straight from the book, Stockfish isn't even started
+    engine = None
+    move = book_move(st.session_state.board)
+    if not move:
+        engine = get_engine()
+        if not engine: return
+        if reply and st.session_state.board.is_legal(reply):
+            move = reply
+        else:
+            # Fixed depth so easy positions return early, skip the info lines
+            try:
+                with engine_slot()["lock"]:
+                    move = engine.play(
+                        st.session_state.board,
+                        chess.engine.Limit(depth=st.session_state.ai_depth),
+                        info=chess.engine.INFO_NONE,
+                        ponder=False
+                    ).move
+            except chess.engine.EngineError:
+                drop_engine(engine)
+                return
+    st.session_state.board.push(move)
+    remember_position()
+    st.session_state.history.append(f"AI: {move}")
+    
+    # Keep thinking on the user's time
+    if engine and not game_over():
+        try:
+            with engine_slot()["lock"]:
+                analysis = engine.analysis(st.session_state.board, chess.engine.Limit(time=10))
+            st.session_state.ponder = (engine, analysis)
+        except chess.engine.EngineError:
+            drop_engine(engine)
 
 def restart_game(color):
+    stop_ponder()
     st.session_state.board.reset()
+    remember_position()
+    st.session_state.last_processed_uci = None
+    # New component key, so the last move of the old game isn't handed back
+    st.session_state.game_id += 1
     st.session_state.history = []
-    st.session_state.ai_side = chess.BLACK if color == "White" else chess.WHITE
+    st.session_state.ai_is_white = color == "Black"
     
-    if st.session_state.ai_side == chess.WHITE:
+    if st.session_state.ai_is_white:
         make_ai_move()
     st.rerun()
 
@@ -70,64 +213,100 @@ def restart_game(color):
 st.title("♟️ Chess AI")
 
 # -- CONTROLS --
-col1, col2 = st.columns([1, 1])
-with col1:
-    user_side = st.selectbox("Play As:", ["White", "Black"])
-with col2:
-    if st.button("🔄 New Game", use_container_width=True):
-        restart_game(user_side)
-
-# -- THE BOARD --
-# Determine orientation
-orientation = "white" if st.session_state.ai_side == chess.BLACK else "black"
-
-# This component handles the Drag & Drop AND Clicks
-# It returns the move ONLY when you finish the action
-move_data = chessboard(
-    st.session_state.board.fen(), 
-    orientation=orientation, 
-    key="game_board",
-    width=350, # Optimized size for mobile
-    height=350
-)
-
-# -- MOVE HANDLING --
-if move_data:
-    # 1. Parse the move from the UI component
-    move_str = move_data["source"] + move_data["target"]
-    move = chess.Move.from_uci(move_str)
-    
-    # 2. Check Promotion (Auto-Queen)
-    if move_str in [m.uci()[:4] for m in st.session_state.board.legal_moves]:
-        # If it's a legal move but missing promotion char, assume Queen
-        move = chess.Move.from_uci(move_str + "q")
-
-    # 3. Apply Move
-    if move in st.session_state.board.legal_moves:
-        # Only push if it's a new move (prevents loop)
-        if st.session_state.board.fen() != move_data["fen"]:
-            st.session_state.board.push(move)
+st.sidebar.slider("AI Depth", min_value=1, max_value=20, value=12, key="ai_depth")
+
+# A form so picking a side doesn't rerun the script until New Game is hit
+with st.form("new_game_form", border=False):
+    col1, col2 = st.columns([1, 1])
+    with col1:
+        user_side = st.selectbox("Play As:", ["White", "Black"])
+    with col2:
+        new_game = st.form_submit_button("🔄 New Game", use_container_width=True)
+if new_game:
+    restart_game(user_side)
+
+# -- PLAY AREA --
+# Only this block re-runs on a move, the title and controls stay put
+@st.fragment
+def play_area():
+    # Only reruns after this first call are fragment reruns, a full run of
+    # the script resets the flag right before calling us
+    fragment_run = st.session_state.fragment_run
+    st.session_state.fragment_run = True
+
+    # Look everything up once per rerun, any move below reruns the fragment
+    board = st.session_state.board
+    over = game_over()
+    in_check = not over and board.is_check()
+
+    # -- THE BOARD --
+    # Determine orientation
+    orientation = "black" if st.session_state.ai_is_white else "white"
+
+    # This component handles the Drag & Drop AND Clicks
+    # It returns the move ONLY when you finish the action
+    move_data = chessboard(
+        st.session_state.last_fen, # Cached on every push/reset
+        orientation=orientation, 
+        key=f"game_board_{st.session_state.game_id}",
+        width=350, # Optimized size for mobile
+        height=350
+    )
+
+    # -- MOVE HANDLING --
+    # Streamlit hands back the same move_data on every rerun, so skip it
+    # before parsing if it was already applied (prevents loop).
+    # Once the game is over no more moves are taken
+    if (not over and move_data
+            and fen_key(move_data["fen"]) != st.session_state.pos_key
+            and move_data["source"] + move_data["target"] != st.session_state.last_processed_uci):
+        # 1. Parse the move from the UI component
+        move_str = move_data["source"] + move_data["target"]
+        try:
+            move = chess.Move.from_uci(move_str)
+        except ValueError:
+            # Garbage from the component, remember it so it isn't parsed again
+            st.session_state.last_processed_uci = move_str
+            move = None
+
+        # 2. Check Promotion (Auto-Queen)
+        if move is not None:
+            piece = board.piece_at(move.from_square)
+            if piece and piece.piece_type == chess.PAWN and chess.square_rank(move.to_square) in (0, 7):
+                # Pawn reaching the last rank without a promotion char, assume Queen
+                move = chess.Move(move.from_square, move.to_square, promotion=chess.QUEEN)
+
+        # 3. Apply Move
+        if move is not None and board.is_legal(move):
+            reply = stop_ponder(move)
+            board.push(move)
+            remember_position()
+            st.session_state.last_processed_uci = move_str
             st.session_state.history.append(f"You: {move}")
-            
+
             # AI Reply
-            if not st.session_state.board.is_game_over():
+            if not game_over():
                 with st.spinner("AI Thinking..."):
-                    make_ai_move()
-            
-            # Force refresh to update the visual board
-            st.rerun()
-
-# -- STATUS --
-if st.session_state.board.is_game_over():
-    res = st.session_state.board.result()
-    msg = "Draw"
-    if res == "1-0": msg = "White Wins!"
-    elif res == "0-1": msg = "Black Wins!"
-    st.success(f"🏆 {msg}")
-elif st.session_state.board.is_check():
-    st.error("Check!")
-
-# -- HISTORY --
-with st.expander("Move History"):
-    for move in st.session_state.history:
-        st.caption(move)
+                    make_ai_move(reply)
+
+            # Force refresh to update the visual board. scope="fragment" is
+            # only allowed during a fragment rerun
+            st.rerun(scope="fragment" if fragment_run else "app")
+
+    # -- STATUS --
+    if over:
+        # result() says "*" for threefold/50-move, so decide it here
+        msg = "Draw"
+        if board.is_checkmate():
+            msg = "Black Wins!" if board.turn == chess.WHITE else "White Wins!"
+        st.success(f"🏆 {msg}")
+    elif in_check:
+        st.error("Check!")
+
+    # -- HISTORY --
+    with st.expander("Move History"):
+        # One element for the whole list instead of one per move
+        st.text("\n".join(st.session_state.history))
+
+st.session_state.fragment_run = False
+play_area()